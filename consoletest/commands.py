@@ -5,41 +5,63 @@ import os
 import abc
 import sys
 import json
-import time
-import copy
 import shlex
+import shutil
 import signal
 import atexit
 import asyncio
 import pathlib
 import inspect
-import tempfile
 import functools
 import contextlib
 import subprocess
 import http.server
-from typing import IO, Any, Dict, List, Union, Optional
+from typing import IO, Any, Dict, List, Tuple, Union, Optional
+
+from .run_commands import run_commands_capture_output, wait_proc
+from .util import build_compare_output_fn
+
+# Used by SimpleHTTPServerCommand to serve on a random port if installed
+with contextlib.suppress(ModuleNotFoundError):
+    import httptest
 
 
 class ConsoletestCommand(abc.ABC):
+    # True on commands which execute a command line and therefore carry a
+    # .cmd argv which :replace: may rewrite. A class attribute read costs
+    # less than an isinstance check against the class hierarchy and lets
+    # command classes from outside this module opt in without inheriting
+    # from ConsoleCommand.
+    is_console = False
+
     def __init__(self):
         self.poll_until = False
         self.compare_output = None
         self.compare_output_imports = None
+        # Compiled form of compare_output, built on first use
+        self._compare_fn = None
         self.ignore_errors = False
         self.daemon = None
+        # Commands in the same parallel group within a code block are run
+        # concurrently. None means the command runs sequentially, commands
+        # which mutate shared state (cd, venv activation) must stay None.
+        self.parallel_group = None
 
     def __repr__(self):
+        # The set of public attributes is static per subclass, compute it on
+        # first use and cache on the class instead of building a filtered
+        # dict on every call.
+        cls = type(self)
+        fields = cls.__dict__.get("_REPR_FIELDS")
+        if fields is None:
+            fields = tuple(
+                key for key in self.__dict__ if not key.startswith("_")
+            )
+            cls._REPR_FIELDS = fields
         return (
-            self.__class__.__qualname__
+            cls.__qualname__
             + "("
-            + str(
-                {
-                    k: v
-                    for k, v in self.__dict__.items()
-                    if not k.startswith("_")
-                }
-            )
+            + ", ".join(f"{key}={getattr(self, key)!r}" for key in fields)
             + ")"
         )
 
@@ -56,19 +78,48 @@ class ConsoletestCommand(abc.ABC):
     def check(cls, cmd):
         raise NotImplementedError
 
+    @classmethod
+    def first_tokens(cls) -> Tuple[str, ...]:
+        """
+        Tokens which, when seen as the first argument of a command line, mean
+        this command's check() might apply. An empty tuple means the command
+        cannot be ruled out by the first token and check() must always run.
+        """
+        return ()
+
+
+# Cache of absolute paths for (cwd, directory) pairs. Suites replay the same
+# cd / venv activation lines against the same working directories, and
+# os.path.abspath re-normalizes (and calls getcwd()) on every call.
+_ABS_CACHE: Dict[Tuple[str, str], str] = {}
+
+
+def _absjoin(cwd: str, directory: str) -> str:
+    key = (cwd, directory)
+    value = _ABS_CACHE.get(key)
+    if value is None:
+        value = _ABS_CACHE.setdefault(
+            key, os.path.abspath(os.path.join(cwd, directory))
+        )
+    return value
+
 
 class CDCommand(ConsoletestCommand):
     def __init__(self, directory: str):
         super().__init__()
         self.directory = directory
 
+    @classmethod
+    def first_tokens(cls) -> Tuple[str, ...]:
+        return ("cd",)
+
     def __eq__(self, other: "CDCommand"):
         return bool(
             hasattr(other, "directory") and self.directory == other.directory
         )
 
     async def run(self, ctx):
-        ctx["cwd"] = os.path.abspath(os.path.join(ctx["cwd"], self.directory))
+        ctx["cwd"] = _absjoin(ctx["cwd"], self.directory)
 
     @classmethod
     def check(cls, cmd):
@@ -76,23 +127,55 @@ class CDCommand(ConsoletestCommand):
             return cls(cmd[1])
 
 
+# Version of the running interpreter and the venv site-packages suffix that
+# goes with it, computed once instead of per activation/creation
+_PY_VERSION = f"{sys.version_info.major}.{sys.version_info.minor}"
+_SITE_PACKAGES_REL = os.path.join(
+    "lib", "python" + _PY_VERSION, "site-packages"
+)
+
+# Precomputed keys for the conda prefix renumbering loop. os.environb takes
+# byte keys directly and skips the str<->bytes transcoding every os.environ
+# assignment performs; environb does not exist on Windows, so fall back to
+# str keys and os.environ there.
+_USE_ENVIRONB = hasattr(os, "environb")
+if _USE_ENVIRONB:
+    _CONDA_PREFIX_KEYS = tuple(b"CONDA_PREFIX_%d" % i for i in range(1, 33))
+else:
+    _CONDA_PREFIX_KEYS = tuple(f"CONDA_PREFIX_{i}" for i in range(1, 33))
+
+
+def _conda_prefix_key(number: int):
+    if 1 <= number <= len(_CONDA_PREFIX_KEYS):
+        return _CONDA_PREFIX_KEYS[number - 1]
+    return (
+        b"CONDA_PREFIX_%d" % number
+        if _USE_ENVIRONB
+        else f"CONDA_PREFIX_{number}"
+    )
+
+
 class ActivateVirtualEnvCommand(ConsoletestCommand):
     def __init__(self, directory: str):
         super().__init__()
         self.directory = directory
-        self.old_virtual_env = None
-        self.old_virtual_env_dir = None
-        self.old_path = None
-        self.old_pythonpath = None
-        self.old_sys_path = []
-        # Functions to run after activation
-        self.post_activate = set()
+        self.python_path = None
+        # Snapshot of the environment variables activation touches, taken in
+        # run() and restored wholesale in __aexit__
+        self._saved_env = {}
 
-    def register_post_activate(self, func):
-        self.post_activate.add(func)
+    # Functions to run after activation, in registration order. Order
+    # matters: the dffml shim must be on PATH before anything pip installs.
+    post_activate = []
 
-    def unregister_post_activate(self, func):
-        self.post_activate.remove(func)
+    @classmethod
+    def register_post_activate(cls, func):
+        if func not in cls.post_activate:
+            cls.post_activate.append(func)
+
+    @classmethod
+    def unregister_post_activate(cls, func):
+        cls.post_activate.remove(func)
 
     def __eq__(self, other: "ActivateVirtualEnvCommand"):
         return bool(
@@ -109,37 +192,65 @@ class ActivateVirtualEnvCommand(ConsoletestCommand):
         ):
             return cls(".venv")
 
+    @classmethod
+    def first_tokens(cls) -> Tuple[str, ...]:
+        return ("source", ".", ".\\.venv\\Scripts\\activate")
+
     async def run(self, ctx):
-        self.old_virtual_env = os.environ.get("VIRTUAL_ENV", None)
-        self.old_virtual_env_dir = os.environ.get("VIRTUAL_ENV_DIR", None)
-        self.old_path = os.environ.get("PATH", None)
-        self.old_pythonpath = os.environ.get("PYTHONPATH", None)
-        env_path = os.path.abspath(os.path.join(ctx["cwd"], self.directory))
-        os.environ["PATH"] = ":".join(
-            [os.path.join(env_path, "bin")]
-            + os.environ.get("PATH", "").split(":")
+        # Snapshot every variable activation might touch, in one pass, so
+        # deactivation is a single restore loop instead of per-key
+        # save/restore plus a rescan of os.environ for CONDA_PREFIX_* keys.
+        keys = [
+            "VIRTUAL_ENV",
+            "VIRTUAL_ENV_DIR",
+            "PATH",
+            "PYTHONPATH",
+            "CONDA_SHLVL",
+            "CONDA_PREFIX",
+            "CONDA_DEFAULT_ENV",
+        ]
+        conda_prefix_numbers = [
+            int(key[len("CONDA_PREFIX_") :])
+            for key in os.environ
+            if key.startswith("CONDA_PREFIX_")
+        ]
+        keys.extend(
+            f"CONDA_PREFIX_{number}" for number in conda_prefix_numbers
         )
-        os.environ["PYTHONPATH"] = ":".join(
-            os.environ.get("PYTHONPATH", "").split(":")
-            + [
-                os.path.join(
-                    env_path,
-                    "lib",
-                    f"python{sys.version_info.major}.{sys.version_info.minor}",
-                    "site-packages",
-                )
-            ],
+        # Renumbering on activation shifts every CONDA_PREFIX_<n> up one and
+        # writes CONDA_PREFIX_1, so one key past the current highest is also
+        # touched; snapshot it (as absent) so restore removes it.
+        keys.append(
+            "CONDA_PREFIX_%d"
+            % ((max(conda_prefix_numbers) + 1) if conda_prefix_numbers else 1)
+        )
+        self._saved_env = {key: os.environ.get(key) for key in keys}
+        old_path = self._saved_env["PATH"]
+        old_pythonpath = self._saved_env["PYTHONPATH"]
+        env_path = _absjoin(ctx["cwd"], self.directory)
+        # Splice with os.pathsep (':' was hardcoded, wrong on Windows) and
+        # keep the previous values verbatim so restoring in __aexit__ is a
+        # single assignment rather than a split/join round trip.
+        bin_path = os.path.join(env_path, "bin")
+        os.environ["PATH"] = (
+            bin_path + os.pathsep + old_path if old_path else bin_path
+        )
+        site_packages_path = os.path.join(env_path, _SITE_PACKAGES_REL)
+        os.environ["PYTHONPATH"] = (
+            old_pythonpath + os.pathsep + site_packages_path
+            if old_pythonpath
+            else site_packages_path
         )
         # conda
         if "CONDA_PREFIX" in os.environ:
             print("CONDA", env_path)
-            # Bump all prefixes up
-            for key, value in filter(
-                lambda i: i[0].startswith("CONDA_PREFIX_"),
-                list(os.environ.items()),
-            ):
-                prefix = int(key[len("CONDA_PREFIX_") :])
-                os.environ[f"CONDA_PREFIX_{prefix + 1}"] = value
+            # Bump all prefixes up, highest first so no slot is overwritten
+            # before its value has been moved
+            environ = os.environb if _USE_ENVIRONB else os.environ
+            for number in sorted(conda_prefix_numbers, reverse=True):
+                environ[_conda_prefix_key(number + 1)] = environ[
+                    _conda_prefix_key(number)
+                ]
             # Add new prefix
             old_shlvl = int(os.environ["CONDA_SHLVL"])
             os.environ["CONDA_SHLVL"] = str(old_shlvl + 1)
@@ -153,7 +264,7 @@ class ActivateVirtualEnvCommand(ConsoletestCommand):
 
         for env_var in ["VIRTUAL_ENV", "CONDA_PREFIX"]:
             if env_var in os.environ:
-                python_path = os.path.abspath(
+                self.python_path = os.path.abspath(
                     os.path.join(os.environ[env_var], "bin", "python")
                 )
         # Run post install hooks
@@ -161,57 +272,64 @@ class ActivateVirtualEnvCommand(ConsoletestCommand):
             await func(self, ctx)
 
     async def __aexit__(self, _exc_type, _exc_value, _traceback):
-        if self.old_virtual_env is not None:
-            os.environ["VIRTUAL_ENV"] = self.old_virtual_env
-        if self.old_virtual_env_dir is not None:
-            os.environ["VIRTUAL_ENV_DIR"] = self.old_virtual_env_dir
-        if self.old_path is not None:
-            os.environ["PATH"] = self.old_path
-        if self.old_pythonpath is not None:
-            os.environ["PYTHONPATH"] = self.old_pythonpath
-        # conda
-        if "CONDA_PREFIX" in os.environ:
-            # Decrement shell level
-            os.environ["CONDA_SHLVL"] = str(int(os.environ["CONDA_SHLVL"]) - 1)
-            if int(os.environ["CONDA_SHLVL"]) == 0:
-                del os.environ["CONDA_SHLVL"]
-            # Bump all prefixes down
-            for key, value in filter(
-                lambda i: i[0].startswith("CONDA_PREFIX_"),
-                list(os.environ.items()),
-            ):
-                del os.environ[key]
-                prefix = int(key[len("CONDA_PREFIX_") :])
-                if prefix == 1:
-                    lower_key = "CONDA_PREFIX"
-                    os.environ["CONDA_PREFIX"] = value
-                    os.environ["CONDA_DEFAULT_ENV"] = value
-                else:
-                    os.environ[f"CONDA_PREFIX_{prefix - 1}"] = value
+        # Re-apply the pre-activation snapshot in one pass. This also undoes
+        # the conda prefix renumbering without rescanning os.environ.
+        for key, value in self._saved_env.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+        self._saved_env = {}
 
 
-# TODO DFFML move to dffml
-ActivateVirtualEnvCommand.register_post_activate(prepend_dffml_to_path)
+# Cache of dffml shim scripts keyed on the Python interpreter they exec, so
+# repeated venv activations reuse one shim instead of paying for a temporary
+# directory creation and removal per activation. All shims live under one
+# lazily created directory which is removed at interpreter exit.
+_DFFML_SHIM_CACHE: Dict[str, pathlib.Path] = {}
+_DFFML_SHIM_DIR: Optional[str] = None
 
 
-def prepend_dffml_to_path(self, ctx):
+async def prepend_dffml_to_path(self, ctx):
     # Prepend a dffml command to the path to ensure the correct
     # version of dffml always runs
-    # Write out the file
-    tempdir = ctx["stack"].enter_context(tempfile.TemporaryDirectory())
-    dffml_path = pathlib.Path(os.path.abspath(tempdir), "dffml")
-    dffml_path.write_text(
-        inspect.cleandoc(
-            f"""
-        #!{python_path}
-        import os
-        import sys
-
-        os.execv("{python_path}", ["{python_path}", "-m", "dffml", *sys.argv[1:]])
-        """
+    global _DFFML_SHIM_DIR
+    python_path = self.python_path
+    dffml_path = _DFFML_SHIM_CACHE.get(python_path)
+    if dffml_path is None:
+        if _DFFML_SHIM_DIR is None:
+            # Deferred: tempfile is only needed once commands actually run
+            import tempfile
+
+            _DFFML_SHIM_DIR = tempfile.mkdtemp(prefix="consoletest-dffml-")
+            atexit.register(
+                shutil.rmtree, _DFFML_SHIM_DIR, ignore_errors=True
+            )
+        # Write out the file
+        dffml_path = pathlib.Path(
+            _DFFML_SHIM_DIR, str(len(_DFFML_SHIM_CACHE)), "dffml"
+        )
+        dffml_path.parent.mkdir()
+        dffml_path.write_text(
+            inspect.cleandoc(
+                f"""
+            #!{python_path}
+            import os
+            import sys
+
+            os.execv("{python_path}", ["{python_path}", "-m", "dffml", *sys.argv[1:]])
+            """
+            )
         )
+        dffml_path.chmod(0o755)
+        _DFFML_SHIM_CACHE[python_path] = dffml_path
+    os.environ["PATH"] = os.pathsep.join(
+        [str(dffml_path.parent), os.environ.get("PATH", "")]
     )
-    dffml_path.chmod(0o755)
+
+
+# TODO DFFML move to dffml
+ActivateVirtualEnvCommand.register_post_activate(prepend_dffml_to_path)
 
 
 class HTTPServerCMDDoesNotHavePortFlag(Exception):
@@ -219,8 +337,8 @@ class HTTPServerCMDDoesNotHavePortFlag(Exception):
 
 
 def pipes(cmd):
-    if not "|" in cmd:
-        return [cmd]
+    # Single pass over argv, the common no-pipe case costs one scan instead
+    # of a containment pre-check followed by a second scan to split.
     cmds = []
     j = 0
     for i, arg in enumerate(cmd):
@@ -231,10 +349,23 @@ def pipes(cmd):
     return cmds
 
 
-async def stop_daemon(proc):
+async def stop_daemon(proc, *, timeout: float = 10.0):
+    # A daemon which exited or died on its own has nothing left to signal;
+    # asyncio's Process.send_signal raises ProcessLookupError once the child
+    # has been reaped, unlike Popen's which no-ops, and either way the pid
+    # could already have been reused.
+    if proc.returncode is not None:
+        return
     # Send ctrl-c to daemon if running
-    proc.send_signal(signal.SIGINT)
-    proc.wait()
+    with contextlib.suppress(ProcessLookupError):
+        proc.send_signal(signal.SIGINT)
+    try:
+        await asyncio.wait_for(wait_proc(proc), timeout)
+    except asyncio.TimeoutError:
+        # Daemon ignored ctrl-c, force it down
+        with contextlib.suppress(ProcessLookupError):
+            proc.kill()
+        await wait_proc(proc)
 
 
 class OutputComparisionError(Exception):
@@ -250,6 +381,8 @@ def buf_to_fileobj(buf: Union[str, bytes]):
     of bytes buffer to the file. Seek to the beginning of the file. Yield the
     file object.
     """
+    import tempfile
+
     if isinstance(buf, str):
         buf = buf.encode()
     with tempfile.TemporaryFile() as fileobj:
@@ -259,6 +392,8 @@ def buf_to_fileobj(buf: Union[str, bytes]):
 
 
 class ConsoleCommand(ConsoletestCommand):
+    is_console = True
+
     def __init__(self, cmd: List[str]):
         super().__init__()
         self.cmd = cmd
@@ -266,19 +401,30 @@ class ConsoleCommand(ConsoletestCommand):
         self.replace = None
         self.stdin = None
         self.stdin_fileobj = None
-        self.stack = contextlib.ExitStack()
-        self.astack = contextlib.AsyncExitStack()
-        # Custom functions that can modify the command line
-        self.fixups = set()
 
-    def register_fixup(self, fixup):
-        self.fixups.add(fixup)
+    # Custom functions that can modify the command line, run in registration
+    # order. Each subclass gets its own registry so registering a fixup on
+    # PipInstallCommand doesn't run it for every ConsoleCommand.
+    fixups: List = []
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.fixups = []
+
+    @classmethod
+    def register_fixup(cls, fixup):
+        if fixup not in cls.fixups:
+            cls.fixups.append(fixup)
 
-    def unregister_fixup(self, fixup):
-        self.fixups.remove(fixup)
+    @classmethod
+    def unregister_fixup(cls, fixup):
+        cls.fixups.remove(fixup)
 
     async def run_fixups(self, ctx):
-        cmd = copy.copy(self.cmd)
+        # No fixups registered is the common case, skip the copy entirely
+        if not self.fixups:
+            return self.cmd
+        cmd = list(self.cmd)
         for fixup in self.fixups:
             cmd = await fixup(ctx, cmd)
         return cmd
@@ -295,7 +441,7 @@ class ConsoleCommand(ConsoletestCommand):
             await stop_daemon(ctx["daemons"][self.daemon].daemon_proc)
         if self.compare_output is None:
             with contextlib.ExitStack() as stack:
-                self.daemon_proc = await self.ctx["run_commands"](
+                self.daemon_proc = await ctx["run_commands"](
                     pipes(self.cmd),
                     ctx,
                     stdin=None
@@ -307,42 +453,47 @@ class ConsoleCommand(ConsoletestCommand):
                 if self.daemon is not None:
                     ctx["daemons"][self.daemon] = self
         else:
-            while True:
-                with contextlib.ExitStack() as stack:
-                    stdout = stack.enter_context(tempfile.TemporaryFile())
-                    await self.ctx["run_commands"](
+            # Poll with an exponentially backed off asyncio sleep so that the
+            # event loop is free to run other tasks (daemons, other documents)
+            # while we wait for the command's output to match.
+            if self._compare_fn is None:
+                # Compile the user supplied expression into a callable once,
+                # not once per poll iteration
+                self._compare_fn = build_compare_output_fn(
+                    self.compare_output,
+                    imports=self.compare_output_imports,
+                )
+            with contextlib.ExitStack() as stack:
+                # Write stdin out once and rewind it per poll iteration,
+                # instead of encoding the buffer into a fresh TemporaryFile
+                # on every poll.
+                stdin = (
+                    None
+                    if self.stdin is None
+                    else stack.enter_context(buf_to_fileobj(self.stdin))
+                )
+                delay = 0.01
+                while True:
+                    if stdin is not None:
+                        stdin.seek(0)
+                    stdout = await run_commands_capture_output(
                         pipes(self.cmd),
                         ctx,
-                        stdin=None
-                        if self.stdin is None
-                        else stack.enter_context(buf_to_fileobj(self.stdin)),
-                        stdout=stdout,
+                        stdin=stdin,
                         ignore_errors=self.ignore_errors,
                     )
-                    stdout.seek(0)
-                    stdout = stdout.read()
-                    if call_compare_output(
-                        self.compare_output,
-                        stdout,
-                        imports=self.compare_output_imports,
-                    ):
+                    if self._compare_fn(stdout):
                         return
-                if not self.poll_until:
-                    raise OutputComparisionError(
-                        f"{self.cmd}: {self.compare_output}: {stdout.decode()}"
-                    )
-                time.sleep(0.1)
-
-    async def __aenter__(self):
-        await self.astack.__enter__()
-        self.stack.__enter__()
-        return self
+                    if not self.poll_until:
+                        raise OutputComparisionError(
+                            f"{self.cmd}: {self.compare_output}: {stdout.decode()}"
+                        )
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, 0.1)
 
     async def __aexit__(self, _exc_type, _exc_value, _traceback):
         if self.daemon_proc is not None:
             await stop_daemon(self.daemon_proc)
-        self.stack.__exit__(None, None, None)
-        await self.astack.__exit__(None, None, None)
 
 
 class CreateVirtualEnvCommand(ConsoleCommand):
@@ -357,20 +508,24 @@ class CreateVirtualEnvCommand(ConsoleCommand):
 
     @classmethod
     def check(cls, cmd):
-        # Handle virtualenv creation
-        if (
-            "-m" in cmd
-            and "venv" in cmd
-            and cmd[cmd.index("-m") + 1] == "venv"
-        ) or (cmd[:2] == ["conda", "create"]):
+        # Handle virtualenv creation. One pass over argv instead of separate
+        # containment scans for "-m" and "venv" followed by an index().
+        if cmd[:2] == ["conda", "create"]:
             return cls(cmd[-1])
+        for i, arg in enumerate(cmd):
+            if arg == "-m" and cmd[i + 1 : i + 2] == ["venv"]:
+                return cls(cmd[-1])
+
+    @classmethod
+    def first_tokens(cls) -> Tuple[str, ...]:
+        return ("python", "python3", "conda")
 
     async def run(self, ctx):
         if "CONDA_PREFIX" in os.environ:
             self.cmd = [
                 "conda",
                 "create",
-                f"python={sys.version_info.major}.{sys.version_info.minor}",
+                "python=" + _PY_VERSION,
                 "-y",
                 "-p",
                 self.directory,
@@ -391,18 +546,28 @@ class PipInstallCommand(ConsoleCommand):
     def __init__(self, cmd: List[str]):
         super().__init__(cmd)
         self.directories: List[str] = []
-        # Ensure that we are running pip using it's module invocation
-        if tuple(self.cmd[:2]) not in (("python", "-m"), ("python3", "-m")):
+        # Ensure that we are running pip using it's module invocation.
+        # Versioned interpreters (python3.9) count, run_commands rewrites
+        # any python* argv[0] to the correct interpreter.
+        if not (
+            self.cmd[:1]
+            and self.cmd[0].startswith("python")
+            and self.cmd[1:2] == ["-m"]
+        ):
             raise PipNotRunAsModule(cmd)
 
     @classmethod
     def check(cls, cmd):
-        if (
-            "pip" in cmd
-            and "install" in cmd
-            and cmd[cmd.index("pip") + 1] == "install"
-        ):
-            return cls(cmd)
+        # One pass: look for "pip" immediately followed by "install"
+        for i, arg in enumerate(cmd):
+            if arg == "pip" and cmd[i + 1 : i + 2] == ["install"]:
+                return cls(cmd)
+
+    @classmethod
+    def first_tokens(cls) -> Tuple[str, ...]:
+        # "pip" so that a bare pip install reaches the PipNotRunAsModule
+        # guard instead of falling through to the default command
+        return ("python", "python3", "pip")
 
     async def run(self, ctx):
         await super().run(ctx)
@@ -431,6 +596,22 @@ class PipInstallCommand(ConsoleCommand):
         return
 
 
+# Containers still needing removal at interpreter exit, flushed with one
+# docker rm -f invocation instead of a stop + rm subprocess pair each.
+_PENDING_DOCKER_RM = set()
+
+
+def _flush_pending_docker_rm():
+    if _PENDING_DOCKER_RM:
+        subprocess.check_call(
+            ["docker", "rm", "-f", *sorted(_PENDING_DOCKER_RM)]
+        )
+        _PENDING_DOCKER_RM.clear()
+
+
+atexit.register(_flush_pending_docker_rm)
+
+
 class DockerRunCommand(ConsoleCommand):
     def __init__(self, cmd: List[str]):
         name, needs_removal, cmd = self.find_name(cmd)
@@ -444,6 +625,10 @@ class DockerRunCommand(ConsoleCommand):
         if cmd[:2] == ["docker", "run"]:
             return cls(cmd)
 
+    @classmethod
+    def first_tokens(cls) -> Tuple[str, ...]:
+        return ("docker",)
+
     @staticmethod
     def find_name(cmd):
         """
@@ -451,22 +636,29 @@ class DockerRunCommand(ConsoleCommand):
         """
         name = None
         needs_removal = bool("--rm" not in cmd)
-        for i, arg in enumerate(cmd):
-            if arg.startswith("--name="):
-                name = arg[len("--name=") :]
-            elif arg == "--name" and (i + 1) < len(cmd):
-                name = cmd[i + 1]
+        # list.index runs the search in C; only fall back to the Python
+        # level scan for the rarer --name=value spelling
+        try:
+            name = cmd[cmd.index("--name") + 1]
+        except (ValueError, IndexError):
+            for arg in cmd:
+                if arg.startswith("--name="):
+                    name = arg[len("--name=") :]
         return name, needs_removal, cmd
 
     def cleanup(self):
         if self.name and not self.stopped:
-            subprocess.check_call(["docker", "stop", self.name])
-            if self.needs_removal:
-                subprocess.check_call(["docker", "rm", self.name])
+            # rm -f stops and removes in one subprocess, covering both the
+            # --rm and needs_removal cases
+            subprocess.check_call(["docker", "rm", "-f", self.name])
         self.stopped = True
+        _PENDING_DOCKER_RM.discard(self.name)
 
     async def __aenter__(self):
-        atexit.register(self.cleanup)
+        if self.name:
+            # If the process dies before __aexit__ runs, the batched atexit
+            # docker rm -f picks this container up
+            _PENDING_DOCKER_RM.add(self.name)
         return self
 
     async def __aexit__(self, _exc_type, _exc_value, _traceback):
@@ -483,6 +675,10 @@ class SimpleHTTPServerCommand(ConsoleCommand):
         if cmd[1:3] == ["-m", "http.server"]:
             return cls(cmd)
 
+    @classmethod
+    def first_tokens(cls) -> Tuple[str, ...]:
+        return ("python", "python3")
+
     async def __aenter__(self) -> "OperationImplementationContext":
         self.ts = None
 
@@ -515,3 +711,15 @@ class SimpleHTTPServerCommand(ConsoleCommand):
     async def __aexit__(self, exc_type, exc_value, traceback):
         self.ts.__exit__(None, None, None)
         self.ts = None
+
+
+# All command classes defined in this module, enumerated once at import time
+# so that callers don't have to rescan the module's namespace with inspect on
+# every Consoletest instantiation.
+ALL = tuple(
+    value
+    for value in tuple(globals().values())
+    if inspect.isclass(value)
+    and issubclass(value, ConsoletestCommand)
+    and value is not ConsoletestCommand
+)
@@ -1,15 +1,13 @@
 import os
-import io
-import enum
 import codecs
-import shutil
-import inspect
+import asyncio
 import pathlib
-import tempfile
+import functools
 import contextlib
 import dataclasses
 from typing import (
     Any,
+    Callable,
     Dict,
     List,
     Union,
@@ -17,10 +15,56 @@ from typing import (
     Optional,
 )
 
-from .commands import ConsoletestCommand, ConsoleCommand, call_replace
-from .util import copyfile
+from .commands import ALL, ConsoletestCommand, ConsoleCommand
+from .run_commands import run_commands
+from .util import copyfile, call_replace
 from .parser import Node, parse_commands
-from .commands import *
+
+
+LITERALINCLUDE_OPTION_SPEC = {
+    "filepath": "unchanged_required",
+    "test": "flag",
+}
+
+CODE_BLOCK_OPTION_SPEC = {
+    "filepath": "unchanged_required",
+    "replace": "unchanged_required",
+    "poll-until": "flag",
+    "compare-output": "unchanged_required",
+    "compare-output-imports": "unchanged_required",
+    "ignore-errors": "flag",
+    "daemon": "unchanged_required",
+    "parallel-group": "unchanged_required",
+    "test": "flag",
+    "stdin": "unchanged_required",
+    "overwrite": "flag",
+}
+
+
+@functools.lru_cache(maxsize=1)
+def _discover_commands() -> Tuple[type, ...]:
+    """
+    Load every command class registered under the consoletest.command entry
+    point group. Entry point discovery rescans installed distributions'
+    metadata on disk every call, which can take hundreds of milliseconds, so
+    the result is cached; call _discover_commands.cache_clear() after
+    installing new command plugins into the running process.
+    """
+    # Deferred: importlib.metadata transitively imports tempfile, zipfile,
+    # email and friends, and is only needed once commands are discovered
+    import importlib.metadata
+
+    loaded = tuple(
+        entry_point.load()
+        for entry_point in importlib.metadata.entry_points().select(
+            group="consoletest.command"
+        )
+    )
+    if not loaded:
+        # Package metadata is not installed, fall back to the builtin
+        # command classes enumerated at import time.
+        loaded = tuple(ALL)
+    return loaded
 
 
 @dataclasses.dataclass
@@ -29,70 +73,88 @@ class ConsoleTestConfig:
     This config object is used to provide command helpers, parsers, etc. which
     need to be present for the full life cycle of parse through execution.
     """
+
     commands: Optional[List[ConsoletestCommand]] = None
     default_command: Optional[ConsoletestCommand] = None
-    literalinclude_option_spec: Dict[str, str] = field(default_factory=lambda: {
-        "filepath": "unchanged_required",
-        "test": "flag",
-    })
-    code_block_option_spec: Dict[str, str] = field(default_factory=lambda: {
-        "filepath": "unchanged_required",
-        "replace": "unchanged_required",
-        "poll-until": "flag",
-        "compare-output": "unchanged_required",
-        "compare-output-imports": "unchanged_required",
-        "ignore-errors": "flag",
-        "daemon": "unchanged_required",
-        "test": "flag",
-        "stdin": "unchanged_required",
-        "overwrite": "flag",
-    })
-    node_handlers: Dict[str, Callable[]]: = field(default_factory=lambda: {})
+    literalinclude_option_spec: Dict[str, str] = dataclasses.field(
+        default_factory=lambda: dict(LITERALINCLUDE_OPTION_SPEC)
+    )
+    code_block_option_spec: Dict[str, str] = dataclasses.field(
+        default_factory=lambda: dict(CODE_BLOCK_OPTION_SPEC)
+    )
+    node_handlers: Dict[str, Callable] = dataclasses.field(
+        default_factory=dict
+    )
 
 
 class Consoletest(ConsoleTestConfig):
+    LITERALINCLUDE_OPTION_SPEC = LITERALINCLUDE_OPTION_SPEC
+    CODE_BLOCK_OPTION_SPEC = CODE_BLOCK_OPTION_SPEC
+
     def __init__(
         self,
         commands: Optional[List[ConsoletestCommand]] = None,
         default_command: Optional[ConsoletestCommand] = None,
-        node_handlers = None,
+        node_handlers=None,
     ):
         # Command class to run if none other match cmd line argument list
         self.default_command = (
-            default_command if default_command is None else ConsoleCommand
+            ConsoleCommand if default_command is None else default_command
         )
         # Initialize to all commands registered as entrypoints if no list given.
         self.commands = commands
         if self.commands is None:
-            self.commands = [
-                entry_point.load()
-                for entry_point in importlib.metadata.entry_points().select(
-                    group="consoletest.command"
-                )
-            ]
+            self.commands = list(_discover_commands())
         # Remove default command from list of commands if it's in the list
         if self.default_command in self.commands:
             self.commands.remove(self.default_command)
-        # Map node types to how their handlers
-        # node["consoletestnodetype"] in self.node_handlers "consoletest-literalinclude":
-        # node["consoletestnodetype"] == "consoletest-file":
-        # node["consoletestnodetype"] == "consoletest":
-        self.node_handlers = node_handlers if isinstance(node_handlers, dict) else {
-            "consoletest-literalinclude": self.literalinclude_to_dict,
-            "consoletest-file": self.,
-            "consoletest": ,
-        }
+        # Dispatch table mapping a command line's first token to the command
+        # classes which might apply, so that build_command() only calls
+        # check() on classes whose first_tokens() claim that token. Classes
+        # which declare no first tokens can never be ruled out and go in the
+        # fallback list.
+        self._dispatch: Dict[str, List[type]] = {}
+        self._fallback: List[type] = []
+        for command_cls in self.commands:
+            first_tokens = command_cls.first_tokens()
+            if not first_tokens:
+                self._fallback.append(command_cls)
+                continue
+            for token in first_tokens:
+                self._dispatch.setdefault(token, []).append(command_cls)
+        # Map node types to their handlers
+        self.node_handlers = (
+            node_handlers
+            if isinstance(node_handlers, dict)
+            else {
+                "consoletest-literalinclude": self.literalinclude,
+                "consoletest-file": self.file,
+                "consoletest": self.consoletest,
+            }
+        )
 
     def build_command(self, cmd):
         if not cmd:
             raise ValueError("Empty command")
-        # Check all registered commands and instantiate an instance of the
-        # command class to manage execution of the command if the command class
-        # is applicable to the cmd line arguments given.
-        for command_cls in self.commands:
+        # Check the command classes registered for the command's first token,
+        # then any which can't be ruled out by first token, and instantiate an
+        # instance of the command class to manage execution of the command if
+        # the command class is applicable to the cmd line arguments given.
+        # Versioned interpreters (python3.9) dispatch like their base
+        # spelling, the same way run_commands rewrites any python* argv[0].
+        candidates = self._dispatch.get(cmd[0])
+        if candidates is None and cmd[0].startswith("python"):
+            candidates = self._dispatch.get("python")
+        for command_cls in candidates or ():
+            command = command_cls.check(cmd)
+            if command is not None:
+                return command
+        for command_cls in self._fallback:
             command = command_cls.check(cmd)
+            if command is not None:
+                return command
         # Instantiate default command when none in the list are applicable.
-        return cls.default_command(cmd)
+        return self.default_command(cmd)
 
     def literalinclude_to_dict(
         self,
@@ -107,7 +169,7 @@ class Consoletest(ConsoleTestConfig):
             raise ValueError('node must have "source" property')
 
         if "test" in options:
-            node["consoletestnodetype"] = self.NODE_TYPE_LITERALINCLUDE
+            node["consoletestnodetype"] = "consoletest-literalinclude"
             node["lines"] = options.get("lines", None)
             node["filepath"] = options.get(
                 "filepath", os.path.basename(node["source"])
@@ -138,21 +200,34 @@ class Consoletest(ConsoleTestConfig):
             )
 
             node["consoletest_commands_replace"] = options.get("replace", None)
+            # The options apply identically to every command in the block,
+            # so resolve them (and decode stdin) once rather than per command
+            poll_until = bool("poll-until" in options)
+            compare_output = options.get("compare-output", None)
+            compare_output_imports = options.get(
+                "compare-output-imports", None
+            )
+            if poll_until and compare_output is None:
+                raise ValueError("Cannot set poll-until without compare-output")
+            ignore_errors = bool("ignore-errors" in options)
+            parallel_group = options.get("parallel-group", None)
+            stdin = None
+            if "stdin" in options:
+                stdin = codecs.getdecoder("unicode_escape")(
+                    options["stdin"]
+                )[0]
             for command in node["consoletest_commands"]:
-                command.poll_until = bool("poll-until" in options)
-                command.compare_output = options.get("compare-output", None)
-                command.compare_output_imports = options.get(
-                    "compare-output-imports", None
-                )
-                if command.poll_until and command.compare_output is None:
-                    raise ValueError(
-                        "Cannot set poll-until without compare-output"
-                    )
-                command.ignore_errors = bool("ignore-errors" in options)
-                if "stdin" in options:
-                    command.stdin = codecs.getdecoder("unicode_escape")(
-                        options["stdin"]
-                    )[0]
+                command.poll_until = poll_until
+                command.compare_output = compare_output
+                command.compare_output_imports = compare_output_imports
+                command.ignore_errors = ignore_errors
+                # Only console commands may run concurrently; commands which
+                # mutate shared state (cd, venv activation) keep the default
+                # of None so they always run sequentially
+                if command.is_console:
+                    command.parallel_group = parallel_group
+                if stdin is not None:
+                    command.stdin = stdin
 
             # Last command to be run is a daemon
             if "daemon" in options:
@@ -160,7 +235,7 @@ class Consoletest(ConsoleTestConfig):
 
         return node
 
-    def nodes_to_test(nodes: List[Node]) -> List[Node]:
+    def nodes_to_test(self, nodes: List[Node]) -> List[Node]:
         """
         List of nodes to subset of that list which have the ``:test::`` option.
         """
@@ -190,98 +265,157 @@ class Consoletest(ConsoleTestConfig):
         docs_root_dir: Union[str, pathlib.Path],
         nodes: List[Dict[str, Any]],
         *,
-        setup: Optional[List[ConsoletestCommand]] = None,
+        setup: Optional[Callable] = None,
     ) -> None:
+        # Deferred: only run_nodes needs tempfile, parsing callers skip the
+        # import entirely (resolves to a cached sys.modules lookup after the
+        # first run)
+        import tempfile
+
         # Ensure pathlib objects
         repo_root_dir = pathlib.Path(repo_root_dir).resolve()
         docs_root_dir = pathlib.Path(docs_root_dir).resolve()
-        # Create an async exit stack
-        async with contextlib.AsyncExitStack() as astack:
-            tempdir = stack.enter_context(tempfile.TemporaryDirectory())
-
-            ctx = {
-                "root": str(repo_root_dir),
-                "docs": str(docs_root_dir),
-                "cwd": tempdir,
-                "stack": stack,
-                "astack": astack,
-                "daemons": {},
-                # Items in this context that must are not serializable
-                "no_serialize": {"stack", "astack", "daemons"},
-            }
-
-            # Create a virtualenv for every document
-            if setup is not None:
-                await setup(ctx)
-
-            for node in nodes:  # type: Element
-                if node["consoletestnodetype"] in self.node_handlers:
-                    await self.node_handlers[node["consoletestnodetype"]](ctx, node)
-                else:
-                    raise NotImplementedError("\'consoletestnodetype\' not found in node_handlers")
-
-        def file(self, ctx, node):
-            print()
-            filepath = pathlib.Path(ctx["cwd"], *node["filepath"])
-
-            if not filepath.parent.is_dir():
-                filepath.parent.mkdir(parents=True)
-
-            if node["overwrite"] and filepath.is_file():
-                print("Overwriting", ctx, filepath)
-                mode = "wt"
-            else:
-                print("Writing", ctx, filepath)
-                mode = "at"
-
-            with open(filepath, mode) as outfile:
-                outfile.seek(0, io.SEEK_END)
-                outfile.write("\n".join(node["content"]) + "\n")
-
+        # Create sync and async exit stacks
+        with contextlib.ExitStack() as stack:
+            async with contextlib.AsyncExitStack() as astack:
+                tempdir = stack.enter_context(tempfile.TemporaryDirectory())
+
+                ctx = {
+                    "root": str(repo_root_dir),
+                    "docs": str(docs_root_dir),
+                    "cwd": tempdir,
+                    "stack": stack,
+                    "astack": astack,
+                    "daemons": {},
+                    "run_commands": run_commands,
+                    # Items in this context that are not serializable
+                    "no_serialize": {
+                        "stack",
+                        "astack",
+                        "daemons",
+                        "run_commands",
+                    },
+                }
+
+                # Run test setup given, for example creating a virtualenv
+                if setup is not None:
+                    await setup(ctx)
+
+                # Hoist the handler mapping and its bound get() out of the
+                # loop, one lookup per node instead of two plus an attribute
+                # resolution
+                get_handler = self.node_handlers.get
+                # File and literalinclude nodes only write files into the
+                # tempdir, so consecutive runs of them are overlapped with
+                # gather; any consoletest node flushes the batch first, so
+                # every file exists before a command that might read it runs
+                # and commands themselves stay sequential.
+                batch = []
+
+                async def flush_batch():
+                    if batch:
+                        await asyncio.gather(*batch)
+                        batch.clear()
+
+                for node in nodes:  # type: Element
+                    nodetype = node["consoletestnodetype"]
+                    handler = get_handler(nodetype)
+                    if handler is None:
+                        raise NotImplementedError(
+                            "'consoletestnodetype' not found in node_handlers"
+                        )
+                    if nodetype in (
+                        "consoletest-file",
+                        "consoletest-literalinclude",
+                    ):
+                        batch.append(handler(ctx, node))
+                        continue
+                    await flush_batch()
+                    await handler(ctx, node)
+                await flush_batch()
+
+    async def file(self, ctx, node):
+        print()
+        filepath = pathlib.Path(ctx["cwd"], *node["filepath"])
+
+        if not filepath.parent.is_dir():
+            filepath.parent.mkdir(parents=True)
+
+        if node["overwrite"] and filepath.is_file():
+            print("Overwriting", ctx, filepath)
+            mode = "wt"
+        else:
+            print("Writing", ctx, filepath)
+            mode = "at"
+
+        # Stream the lines out instead of materializing one joined string
+        with open(filepath, mode) as outfile:
+            outfile.writelines(line + "\n" for line in node["content"])
+
+        # Echoing the file costs a full read-back, only do it when asked
+        if ctx.get("verbose", False):
             print(filepath.read_text(), end="")
             print()
 
-        def consoletest(self, ctx, node):
-            if node["consoletest_commands_replace"] is not None:
+    async def consoletest(self, ctx, node):
+        if node["consoletest_commands_replace"] is not None:
+            cmds = [
+                command.cmd if command.is_console else []
+                for command in node["consoletest_commands"]
+            ]
+            # Only spawn the replacement interpreter when there is at least
+            # one command line for it to rewrite
+            if any(cmds):
                 for command, new_cmd in zip(
                     node["consoletest_commands"],
                     call_replace(
-                        node["consoletest_commands_replace"],
-                        list(
-                            map(
-                                lambda command: command.cmd
-                                if isinstance(command, ConsoleCommand)
-                                else [],
-                                node["consoletest_commands"],
-                            )
-                        ),
-                        ctx,
+                        node["consoletest_commands_replace"], cmds, ctx
                     ),
                 ):
-                    if isinstance(command, ConsoleCommand):
+                    if command.is_console:
                         command.cmd = new_cmd
-            for command in node["consoletest_commands"]:
-                print()
-                print("Running", ctx, command)
-                print()
-                await astack.enter_async_context(command)
-                await command.run(ctx)
+        # Commands sharing a parallel_group run concurrently; a group change
+        # or an ungrouped command flushes the batch first, so ordering with
+        # respect to state-mutating commands (cd, activation) is preserved.
+        batch = []
 
-        def literalinclude(self, ctx):
-            lines = node.get("lines", None)
-            if lines is not None:
-                lines = tuple(map(int, lines.split("-")))
+        async def flush_batch():
+            if batch:
+                await asyncio.gather(*(command.run(ctx) for command in batch))
+                batch.clear()
 
-            # Handle navigating out of the docs_root_dir
-            if node["source"].startswith("/.."):
-                node["source"] = node["source"][1:]
+        for command in node["consoletest_commands"]:
+            print()
+            print("Running", ctx, command)
+            print()
+            await ctx["astack"].enter_async_context(command)
+            if command.parallel_group is not None:
+                if (
+                    batch
+                    and batch[0].parallel_group != command.parallel_group
+                ):
+                    await flush_batch()
+                batch.append(command)
+                continue
+            await flush_batch()
+            await command.run(ctx)
+        await flush_batch()
 
-            src = os.path.join(str(docs_root_dir), node["source"])
-            dst = os.path.join(ctx["cwd"], *node["filepath"])
+    async def literalinclude(self, ctx, node):
+        lines = node.get("lines", None)
+        if lines is not None:
+            lines = tuple(map(int, lines.split("-")))
 
-            print()
-            print("Copying", ctx, src, dst, lines)
+        # Handle navigating out of the docs_root_dir
+        if node["source"].startswith("/.."):
+            node["source"] = node["source"][1:]
 
-            copyfile(src, dst, lines=lines)
-            print(pathlib.Path(dst).read_text(), end="")
-            print()
+        src = os.path.join(ctx["docs"], node["source"])
+        dst = os.path.join(ctx["cwd"], *node["filepath"])
+
+        print()
+        print("Copying", ctx, src, dst, lines)
+
+        copyfile(src, dst, lines=lines)
+        print(pathlib.Path(dst).read_text(), end="")
+        print()
@@ -5,13 +5,58 @@ from typing import Dict, List, Union, Any
 
 def within_qoute(current, qoute=('"', "'")):
     within = False
-    for i, char in enumerate(current):
-        context = current[i - 1 : i]
-        if char in qoute and not context.startswith("\\"):
+    prev = ""
+    for char in current:
+        if char in qoute and prev != "\\":
             within = not within
+        prev = char
     return within
 
 
+# Character classes driving the parse_commands state machine; one table
+# lookup per character instead of several membership tests. Characters
+# outside ASCII cannot affect the state and class 0 means "plain".
+_SINGLE_QUOTE = 1
+_DOUBLE_QUOTE = 2
+_BACKTICK = 3
+_OPEN_PAREN = 4
+
+_CHAR_CLASS = bytearray(128)
+_CHAR_CLASS[ord("'")] = _SINGLE_QUOTE
+_CHAR_CLASS[ord('"')] = _DOUBLE_QUOTE
+_CHAR_CLASS[ord("`")] = _BACKTICK
+_CHAR_CLASS[ord("(")] = _OPEN_PAREN
+
+
+def _feed(chunk, within, in_single, prev, substituted):
+    """
+    Advance the quote state machine over chunk. within is the shared
+    single/double quote toggle deciding whether a command continues onto the
+    next line, in_single tracks single quotes alone since only they inhibit
+    command substitution, prev is the previous character seen (for backslash
+    escapes and for spotting the "$(" digraph), substituted records whether
+    an unquoted substitution appeared.
+    """
+    for char in chunk:
+        code = ord(char)
+        cls = _CHAR_CLASS[code] if code < 128 else 0
+        if cls:
+            if cls == _SINGLE_QUOTE:
+                if prev != "\\":
+                    within = not within
+                    in_single = not in_single
+            elif cls == _DOUBLE_QUOTE:
+                if prev != "\\":
+                    within = not within
+            elif cls == _BACKTICK:
+                if not in_single:
+                    substituted = True
+            elif prev == "$" and not in_single:
+                substituted = True
+        prev = char
+    return within, in_single, prev, substituted
+
+
 def parse_commands(content: str, prompt: str = "$ "):
     r"""
     Parse a single or multi line string into the commands run. Commands are
@@ -22,39 +67,36 @@ def parse_commands(content: str, prompt: str = "$ "):
     """
     commands = []
 
+    # Each character of a command is inspected exactly once, as it is
+    # appended, rather than rescanning the accumulated command from the
+    # start on every continuation line and again per substitution check.
     current = ""
+    within = in_single = substituted = False
+    prev = ""
     for line in content:
         line = line.rstrip()
+        continued = line.endswith("\\")
         if line.startswith(prompt):
-            if line.endswith("\\"):
-                current = line[2:-1]
-            else:
-                current = line[2:]
-                if within_qoute(current):
-                    continue
-                commands.append(current)
-                current = ""
-        elif current and line.endswith("\\"):
-            current += line[:-1]
-        elif current and not line.endswith("\\"):
-            current += line
-            if within_qoute(current):
-                continue
-            commands.append(current)
-            current = ""
-
-    # Raise NotImplementedError if command substitution is attempted
-    for command in commands:
-        for check in ("`", "$("):
-            index = 0
-            while index != -1:
-                index = command.find(check, index + 1)
-                if index == -1:
-                    continue
-                if not within_qoute(command[:index], qoute=("'")):
-                    raise NotImplementedError(
-                        f"Command substitution was attempted: {command}"
-                    )
+            within = in_single = substituted = False
+            prev = ""
+            chunk = line[len(prompt) : -1] if continued else line[len(prompt) :]
+            current = chunk
+        elif current:
+            chunk = line[:-1] if continued else line
+            current += chunk
+        else:
+            continue
+        within, in_single, prev, substituted = _feed(
+            chunk, within, in_single, prev, substituted
+        )
+        if continued or within:
+            continue
+        if substituted:
+            raise NotImplementedError(
+                f"Command substitution was attempted: {current}"
+            )
+        commands.append(current)
+        current = ""
 
     try:
         commands = list(map(shlex.split, commands))
@@ -1,41 +1,129 @@
 import os
 import sys
+import asyncio
 import subprocess
-from typing import IO, List, Union
+from typing import IO, Dict, List, Optional, Tuple, Union
 
 
 def sub_env_vars(cmd):
-    for env_var_name, env_var_value in os.environ.items():
-        for i, arg in enumerate(cmd):
-            for check in ["$" + env_var_name, "${" + env_var_name + "}"]:
-                if check in arg:
-                    cmd[i] = arg.replace(check, env_var_value)
-    return cmd
+    # One pass over argv; args without a '$' skip expansion entirely and
+    # os.path.expandvars handles both $VAR and ${VAR} forms in C instead of
+    # a Python-level scan per environment variable.
+    return [os.path.expandvars(arg) if "$" in arg else arg for arg in cmd]
 
 
-@contextlib.contextmanager
-def tmpenv(cmd: List[str]) -> List[str]:
+def _split_env_prefix(
+    cmd: List[str],
+) -> Tuple[List[str], Optional[Dict[str, str]]]:
     """
-    Handle temporary environment variables prepended to command
+    Split temporary environment variables prepended to a command, for
+    example ["FOO=bar", "echo", "hi"], into the remaining argv and an
+    environment for the child process: None when there were no assignments,
+    otherwise a copy of os.environ with them applied. The overrides travel
+    on the child's env rather than through os.environ, so concurrently
+    running commands cannot observe each other's variables.
     """
-    oldvars = {}
-    tmpvars = {}
-    for var in cmd:
-        if "=" not in var:
-            break
-        cmd.pop(0)
-        key, value = var.split("=", maxsplit=1)
-        tmpvars[key] = value
-        if key in os.environ:
-            oldvars[key] = os.environ[key]
-        os.environ[key] = value
-    try:
-        yield cmd
-    finally:
-        for key in tmpvars.keys():
-            del os.environ[key]
-        for key, value in oldvars.items():
-            os.environ[key] = value
+    i = 0
+    while i < len(cmd) and "=" in cmd[i]:
+        i += 1
+    if i == 0:
+        return cmd, None
+    return (
+        cmd[i:],
+        {**os.environ, **dict(arg.split("=", maxsplit=1) for arg in cmd[:i])},
+    )
+
+
+if hasattr(os, "pipe2"):
+
+    def _pipe() -> Tuple[int, int]:
+        # pipe2 sets close-on-exec atomically at creation, so there is no
+        # window in which a concurrently spawned child could inherit both
+        # ends of the pipe and keep a stage from ever seeing EOF. subprocess
+        # re-enables inheritance in the child for the single fd it is handed
+        # as stdin/stdout, which is the only place these fds should cross an
+        # exec.
+        return os.pipe2(os.O_CLOEXEC)
+
+
+else:
+    _pipe = os.pipe
+
+
+async def wait_proc(proc):
+    # asyncio.subprocess.Process.wait is a coroutine; subprocess.Popen.wait
+    # (e.g. handed back by an alternate runner) blocks, so run the latter in
+    # the default executor to keep the event loop free.
+    if asyncio.iscoroutinefunction(proc.wait):
+        await proc.wait()
+    else:
+        await asyncio.get_event_loop().run_in_executor(None, proc.wait)
+
+
+async def run_commands_capture_output(
+    cmds, ctx, *, stdin: Union[IO] = None, ignore_errors: bool = False,
+) -> bytes:
+    """
+    Run a pipeline of commands and return the bytes the last command wrote
+    to stdout. Stages are connected to each other with OS pipes and the last
+    stage's output is read back over a pipe rather than written to a
+    temporary file and read back off disk.
+    """
+    procs = []
+    cmds = list(map(sub_env_vars, cmds))
+    prev_read = None
+    for i, cmd in enumerate(cmds):
+        # Handle temporary environment variables prepended to command
+        cmd, env = _split_env_prefix(cmd)
+        # Keyword arguments for create_subprocess_exec
+        kwargs = {}
+        if env is not None:
+            kwargs["env"] = env
+        kwargs["stdout"] = asyncio.subprocess.PIPE
+        kwargs["stdin"] = stdin if stdin is not None else subprocess.DEVNULL
+        # Check if there is a previous command
+        if i != 0:
+            kwargs["stdin"] = prev_read
+        # Check if there is a next command
+        if i + 1 < len(cmds):
+            read_fd, write_fd = _pipe()
+            kwargs["stdout"] = write_fd
+        # Check if we redirect stderr to stdout
+        if "2>&1" in cmd:
+            kwargs["stderr"] = subprocess.STDOUT
+            cmd.remove("2>&1")
+        # If not in venv ensure correct Python
+        if (
+            "VIRTUAL_ENV" not in (env or os.environ)
+            and "CONDA_PREFIX" not in (env or os.environ)
+            and cmd[0].startswith("python")
+        ):
+            cmd[0] = sys.executable
+        proc = await asyncio.create_subprocess_exec(
+            *cmd, start_new_session=True, cwd=ctx["cwd"], **kwargs
+        )
+        proc.cmd = cmd
+        procs.append(proc)
+        # Parent (this Python process) closes its copies of the pipe ends it
+        # handed off so that each stage has exclusive access and sees EOF
+        # when the stage writing to it exits.
+        if i != 0:
+            os.close(prev_read)
+        if i + 1 < len(cmds):
+            os.close(write_fd)
+            prev_read = read_fd
+    # Drain the last process first, otherwise earlier stages could block
+    # writing into a full pipe that nothing is reading yet.
+    stdout, _ = await procs[-1].communicate()
+    for proc in procs[:-1]:
+        await proc.wait()
+    errors = []
+    for proc in procs:
+        if proc.returncode != 0:
+            errors.append(f"Failed to run: {proc.cmd!r}")
+    if errors and not ignore_errors:
+        raise RuntimeError("\n".join(errors))
+    return stdout
 
 
 async def run_commands(
@@ -48,70 +136,83 @@ async def run_commands(
     daemon: bool = False,
     alternate_runners: Tuple = None,
 ):
-    proc = None
+    # Capture requested, route through the asyncio pipeline which hands the
+    # final stage's output back as bytes over a pipe, no temporary file.
+    if stdout is subprocess.PIPE:
+        return await run_commands_capture_output(
+            cmds, ctx, stdin=stdin, ignore_errors=ignore_errors
+        )
     procs = []
     cmds = list(map(sub_env_vars, cmds))
+    prev_read = None
     for i, cmd in enumerate(cmds):
-        # Keyword arguments for Popen
+        # Handle temporary environment variables prepended to command
+        cmd, env = _split_env_prefix(cmd)
+        # Keyword arguments for create_subprocess_exec
         kwargs = {}
+        if env is not None:
+            kwargs["env"] = env
         # Set stdout to system stdout so it doesn't go to the pty
         kwargs["stdout"] = stdout if stdout is not None else sys.stdout
         # Check if there is a previous command
         kwargs["stdin"] = stdin if stdin is not None else subprocess.DEVNULL
         if i != 0:
-            # NOTE asyncio.create_subprocess_exec doesn't work for piping output
-            # from one process to the next. It will complain about stdin not
-            # having a fileno()
-            kwargs["stdin"] = proc.stdout
+            # Stages are connected with raw pipe fds; handing a previous
+            # stage's StreamReader to stdin= is what create_subprocess_exec
+            # cannot do (no fileno()), an fd works fine.
+            kwargs["stdin"] = prev_read
         # Check if there is a next command
         if i + 1 < len(cmds):
-            kwargs["stdout"] = subprocess.PIPE
+            read_fd, write_fd = _pipe()
+            kwargs["stdout"] = write_fd
         # Check if we redirect stderr to stdout
         if "2>&1" in cmd:
             kwargs["stderr"] = subprocess.STDOUT
             cmd.remove("2>&1")
         # If not in venv ensure correct Python
         if (
-            "VIRTUAL_ENV" not in os.environ
-            and "CONDA_PREFIX" not in os.environ
+            "VIRTUAL_ENV" not in (env or os.environ)
+            and "CONDA_PREFIX" not in (env or os.environ)
             and cmd[0].startswith("python")
         ):
             cmd[0] = sys.executable
-        # Handle temporary environment variables prepended to command
-        with tmpenv(cmd) as cmd:
-            if alternate_runners:
-                # Check if there is an alternate runner
-                found_alternate_runner = False
-                for check, runner in alternate_runners:
-                    found_alternate_runner = await check(cmd, ctx, kwargs)
-                    if found_alternate_runner:
-                        break
+        if alternate_runners:
+            # Check if there is an alternate runner
+            found_alternate_runner = False
+            for check, runner in alternate_runners:
+                found_alternate_runner = await check(cmd, ctx, kwargs)
                 if found_alternate_runner:
-                    # Run the command using the alternate runner
-                    proc = await runner(cmd, ctx, kwargs)
-            else:
-                # Run the command
-                print()
-                print("Running", cmd)
-                print()
-                proc = subprocess.Popen(
-                    cmd, start_new_session=True, cwd=ctx["cwd"], **kwargs
-                )
-            proc.cmd = cmd
-            procs.append(proc)
-        # Parent (this Python process) close stdout of previous command so that
-        # the command we just created has exclusive access to the output.
+                    break
+            if found_alternate_runner:
+                # Run the command using the alternate runner
+                proc = await runner(cmd, ctx, kwargs)
+        else:
+            # Run the command
+            print()
+            print("Running", cmd)
+            print()
+            proc = await asyncio.create_subprocess_exec(
+                *cmd, start_new_session=True, cwd=ctx["cwd"], **kwargs
+            )
+        proc.cmd = cmd
+        procs.append(proc)
+        # Parent (this Python process) closes its copies of the pipe ends it
+        # handed off so that each stage has exclusive access and sees EOF
+        # when the stage writing to it exits.
         if i != 0:
-            kwargs["stdin"].close()
-    # Wait for all processes to complete
+            os.close(prev_read)
+        if i + 1 < len(cmds):
+            os.close(write_fd)
+            prev_read = read_fd
+    # Wait for all processes to complete concurrently. Do not wait for the
+    # last process to complete if running in daemon mode.
+    wait_procs = procs[:-1] if daemon else procs
+    if wait_procs:
+        await asyncio.gather(*(wait_proc(proc) for proc in wait_procs))
     errors = []
-    for i, proc in enumerate(procs):
-        # Do not wait for last process to complete if running in daemon mode
-        if daemon and (i + 1) == len(procs):
-            break
-        proc.wait()
+    for proc in wait_procs:
         if proc.returncode != 0:
-            errors.append(f"Failed to run: {cmd!r}")
+            errors.append(f"Failed to run: {proc.cmd!r}")
     if errors and not ignore_errors:
         raise RuntimeError("\n".join(errors))
     if daemon:
@@ -1,10 +1,27 @@
 import os
 import io
 import sys
+import json
+import itertools
 import shutil
 import pathlib
 import contextlib
-from typing import Any, Union, Tuple, Optional
+import subprocess
+from typing import Any, Dict, List, Union, Tuple, Optional
+
+# orjson serializes and parses several times faster than the stdlib json
+# module; fall back to the stdlib when it is not installed.
+try:
+    import orjson
+
+    _json_dumps = orjson.dumps
+    _json_loads = orjson.loads
+except ImportError:
+
+    def _json_dumps(obj: Any) -> bytes:
+        return json.dumps(obj).encode()
+
+    _json_loads = json.loads
 
 
 @contextlib.contextmanager
@@ -33,48 +50,82 @@ def copyfile(
         dst_path.parent.mkdir(parents=True)
 
     if not lines:
-        shutil.copyfile(src, dst)
+        with open(src, "rb") as infile, open(dst, "wb") as outfile:
+            offset = 0
+            try:
+                # Copy entirely inside the kernel, no shuttling of the data
+                # through userspace buffers; sendfile can stop short on very
+                # large files so loop until everything has moved
+                remaining = os.fstat(infile.fileno()).st_size
+                while remaining > 0:
+                    sent = os.sendfile(
+                        outfile.fileno(), infile.fileno(), offset, remaining
+                    )
+                    if not sent:
+                        break
+                    offset += sent
+                    remaining -= sent
+            except (AttributeError, OSError):
+                # Platform or filesystem without sendfile support; resume
+                # from wherever the kernel copy left off
+                infile.seek(offset)
+                shutil.copyfileobj(infile, outfile, 1024 * 1024)
         return
 
     with open(src, "rt") as infile, open(dst, "at") as outfile:
-        outfile.seek(0, io.SEEK_END)
-        for i, line in enumerate(infile):
-            # Line numbers start at 1
-            i += 1
-            if len(lines) == 1 and i == lines[0]:
-                outfile.write(line)
-                break
-            elif i >= lines[0] and i <= lines[1]:
-                outfile.write(line)
-            elif i > lines[1]:
-                break
-
-
-MAKE_POLL_UNTIL_TEMPLATE = """
-import sys
-{imports}
+        # islice advances the file iterator at C speed instead of a Python
+        # level line counter compared against the window per line. Line
+        # numbers start at 1.
+        if len(lines) == 1:
+            outfile.write(
+                next(itertools.islice(infile, lines[0] - 1, lines[0]), "")
+            )
+        else:
+            outfile.writelines(
+                itertools.islice(infile, lines[0] - 1, lines[1])
+            )
 
-func = lambda stdout: {func}
 
-sys.exit(int(not func(sys.stdin.buffer.read())))
-"""
+def build_compare_output_fn(func: str, *, imports: Optional[str] = None):
+    """
+    Compile a compare-output expression into a callable taking stdout. The
+    imports and the compile happen once here rather than once per call.
+    """
+    namespace = {}
+    if imports is not None:
+        exec("import " + imports, namespace)
+    return eval(
+        compile(f"lambda stdout: {func}", "<compare-output>", "eval"),
+        namespace,
+    )
+
+
+# Compiled compare-output callables and their verdicts for output already
+# seen. Poll loops evaluate the same expression against identical output
+# while a daemon is slow to change state; memoizing both the compile and the
+# evaluation makes those iterations two dict lookups. The result cache is
+# dropped wholesale if it grows unreasonably.
+_COMPARE_FN_CACHE: Dict[Tuple[str, Optional[str]], Any] = {}
+_COMPARE_RESULT_CACHE: Dict[Tuple[str, Optional[str], bytes], bool] = {}
+_COMPARE_RESULT_CACHE_MAX = 1024
 
 
 def call_compare_output(func, stdout, *, imports: Optional[str] = None):
-    with tempfile.NamedTemporaryFile() as fileobj, tempfile.NamedTemporaryFile() as stdin:
-        fileobj.write(
-            MAKE_POLL_UNTIL_TEMPLATE.format(
-                func=func,
-                imports="" if imports is None else "import " + imports,
-            ).encode()
-        )
-        fileobj.seek(0)
-        stdin.write(stdout.encode() if isinstance(stdout, str) else stdout)
-        stdin.seek(0)
-        return_code = subprocess.call(
-            [sys.executable, fileobj.name], stdin=stdin
-        )
-        return bool(return_code == 0)
+    if isinstance(stdout, str):
+        stdout = stdout.encode()
+    key = (func, imports, stdout)
+    result = _COMPARE_RESULT_CACHE.get(key)
+    if result is None:
+        fn = _COMPARE_FN_CACHE.get((func, imports))
+        if fn is None:
+            fn = _COMPARE_FN_CACHE.setdefault(
+                (func, imports),
+                build_compare_output_fn(func, imports=imports),
+            )
+        if len(_COMPARE_RESULT_CACHE) >= _COMPARE_RESULT_CACHE_MAX:
+            _COMPARE_RESULT_CACHE.clear()
+        result = _COMPARE_RESULT_CACHE.setdefault(key, bool(fn(stdout)))
+    return result
 
 
 MAKE_REPLACE_UNTIL_TEMPLATE = """
@@ -94,33 +145,41 @@ print(json.dumps(cmds))
 def call_replace(
     func: str, cmds: List[List[str]], ctx: Dict[str, Any]
 ) -> List[List[str]]:
-    with contextlib.ExitStack() as stack:
+    # Deferred: only :replace: handling needs tempfile
+    import tempfile
+
+    # One temporary directory with three plain files instead of three
+    # NamedTemporaryFile objects, each of which carries its own random name
+    # generation, opener retry loop, and close-time unlink.
+    with tempfile.TemporaryDirectory() as tempdir:
+        python_path = os.path.join(tempdir, "script.py")
+        cmds_path = os.path.join(tempdir, "cmds.json")
+        ctx_path = os.path.join(tempdir, "ctx.json")
         # Write out Python script
-        python_fileobj = stack.enter_context(tempfile.NamedTemporaryFile())
-        python_fileobj.write(
-            MAKE_REPLACE_UNTIL_TEMPLATE.format(func=func).encode()
-        )
-        python_fileobj.seek(0)
+        with open(python_path, "wb") as fileobj:
+            fileobj.write(
+                MAKE_REPLACE_UNTIL_TEMPLATE.format(func=func).encode()
+            )
         # Write out command
-        cmd_fileobj = stack.enter_context(tempfile.NamedTemporaryFile())
-        cmd_fileobj.write(json.dumps(cmds).encode())
-        cmd_fileobj.seek(0)
-        # Write out context
-        ctx_fileobj = stack.enter_context(tempfile.NamedTemporaryFile())
-        ctx_serializable = ctx.copy()
-        for remove in list(ctx["no_serialize"]) + ["no_serialize"]:
-            if remove in ctx_serializable:
-                del ctx_serializable[remove]
-        ctx_fileobj.write(json.dumps(ctx_serializable).encode())
-        ctx_fileobj.seek(0)
+        with open(cmds_path, "wb") as fileobj:
+            fileobj.write(_json_dumps(cmds))
+        # Write out context. Build the serializable subset in one pass over
+        # ctx against a single exclusion set rather than copying everything
+        # and deleting the unwanted keys afterwards.
+        exclude = ctx["no_serialize"] | {"no_serialize"}
+        with open(ctx_path, "wb") as fileobj:
+            fileobj.write(
+                _json_dumps(
+                    {
+                        key: value
+                        for key, value in ctx.items()
+                        if key not in exclude
+                    }
+                )
+            )
         # Python file modifies command and json.dumps result to stdout
-        return json.loads(
+        return _json_loads(
             subprocess.check_output(
-                [
-                    sys.executable,
-                    python_fileobj.name,
-                    cmd_fileobj.name,
-                    ctx_fileobj.name,
-                ],
+                [sys.executable, python_path, cmds_path, ctx_path],
             )
         )